@@ -1,23 +1,54 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-import requests
+import aiohttp
 import re
 import os
 import json
 import io
 import html
 import asyncio
+import signal
+import time
+import hashlib
+from urllib.parse import urlencode, quote
 from datetime import datetime
+from itertools import islice
+from collections import OrderedDict
 from dotenv import load_dotenv
 from typing import Literal
 
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser  # C tokenizer for strip_html
+except ImportError:
+    HTMLParser = None
+
+try:
+    import orjson  # C JSON codec for the data files and Graph responses
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 # ── Bot Setup ──────────────────────────────────────────────────────────────────
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Every command is a slash command, so the message cache is dead weight, and nothing needs
+# the full member list up front. The member cache itself stays on: /mailwhitelist list uses
+# guild.get_member to tell whether whitelisted users are still in the server.
+class EmailBot(commands.Bot):
+    async def setup_hook(self):
+        # Runs inside the loop before the gateway connects. Interactions are dispatched as soon
+        # as they arrive (before on_ready), so the stores and HTTP session must exist by then.
+        open_http_session()
+        load_stores()
+
+bot = EmailBot(
+    command_prefix="!",
+    intents=intents,
+    max_messages=None,
+    chunk_guilds_at_startup=False,
+)
 
 # ── Persistent Storage (Render Disk) ──────────────────────────────────────────
 DATA_DIR = os.getenv("DATA_DIR", ".")
@@ -37,54 +68,144 @@ LOG_CHANNEL_ID = 1399288304767074404
 TOKEN_URL = f"https://login.microsoftonline.com/{DEFAULT_TENANT}/oauth2/v2.0/token"
 GRAPH_URL = "https://graph.microsoft.com/v1.0"
 
+# Shared async HTTP session — keep-alive reuses TLS connections to login/graph across commands.
+# Opened in setup_hook (it must be created inside the running loop), closed on shutdown.
+aiohttp_session: aiohttp.ClientSession | None = None
+
+def open_http_session():
+    global aiohttp_session
+    if aiohttp_session is None or aiohttp_session.closed:
+        aiohttp_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=15),
+            headers={"User-Agent": "discordemail/1.0"},
+        )
+
 
 # ── File helpers (ONLY call these inside file_lock) ───────────────────────────
 
-def _read_tokens() -> dict:
-    if os.path.exists(TOKENS_FILE):
-        with open(TOKENS_FILE, "r") as f:
-            return json.load(f)
-    return {}
+def _json_loads(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def _json_dumps(data) -> bytes:
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode("utf-8")
+
+def _atomic_write(path: str, payload: bytes):
+    """Writes to a temp file and renames it over `path`, so a crash never leaves a truncated file."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+def _load_json(path: str, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, "rb") as f:
+        return _json_loads(f.read())
+
+def _save_json(path: str, data):
+    _atomic_write(path, _json_dumps(data))
+
+async def _asave_json(path: str, data):
+    """_save_json on a worker thread, so a slow (network-mounted) disk can't stall the event loop."""
+    await asyncio.to_thread(_save_json, path, data)
 
-def _write_tokens(tokens: dict):
-    with open(TOKENS_FILE, "w") as f:
-        json.dump(tokens, f, indent=4)
+def _read_tokens() -> dict:
+    return _load_json(TOKENS_FILE, {})
 
 def _read_used_codes() -> dict:
     """Returns {token_prefix: [code1, code2, ...]}"""
-    if os.path.exists(USED_CODES_FILE):
-        with open(USED_CODES_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-def _write_used_codes(data: dict):
-    with open(USED_CODES_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+    return _load_json(USED_CODES_FILE, {})
 
 def _read_emails() -> list:
-    if os.path.exists(EMAILS_FILE):
-        with open(EMAILS_FILE, "r") as f:
-            return json.load(f)
-    return []
-
-def _write_emails(data: list):
-    with open(EMAILS_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+    return _load_json(EMAILS_FILE, [])
 
 def _read_whitelist() -> list:
-    if os.path.exists(WHITELIST_FILE):
-        with open(WHITELIST_FILE, "r") as f:
-            return json.load(f)
-    return []
+    return _load_json(WHITELIST_FILE, [])
+
+async def _write_whitelist(data: list):
+    await _asave_json(WHITELIST_FILE, data)
+
+
+# ── In-memory stores (write-behind) ───────────────────────────────────────────
+# Tokens, used codes and dispenser emails are parsed once in setup_hook and then served from memory.
+# Mutate them in place under file_lock, then call the matching _persist_* to mark the file dirty;
+# a single background flusher coalesces bursts and writes each dirty file at most once a second.
+
+TOKENS: dict = {}
+USED_CODES: dict = {}  # {token_prefix: [code1, code2, ...]}
+EMAILS: list = []      # dispenser queue, oldest first
+EMAIL_KEYS: set = set()  # emails in EMAILS — O(1) duplicate checks for /addmails
+FLUSH_INTERVAL = 1.0
+_STORE_DATA = {TOKENS_FILE: TOKENS, USED_CODES_FILE: USED_CODES, EMAILS_FILE: EMAILS}
+_dirty: set[str] = set()
+_flush_event: asyncio.Event | None = None
+_flusher_task: asyncio.Task | None = None
+_closing = False
+
+def load_stores():
+    global _flush_event, _flusher_task
+    TOKENS.update(_read_tokens())
+    USED_CODES.update(_read_used_codes())
+    EMAILS.extend(_read_emails())
+    EMAIL_KEYS.update(e["email"] for e in EMAILS)
+    _flush_event = asyncio.Event()
+    _flusher_task = asyncio.create_task(_flusher())
+
+async def _flush_dirty():
+    # Serialize on the loop thread (nothing can mutate the store mid-dump), write on a worker thread.
+    # Only the flusher (or flush_stores once it has finished) calls this, so writes never overlap.
+    for path in list(_dirty):
+        _dirty.discard(path)
+        try:
+            await asyncio.to_thread(_atomic_write, path, _json_dumps(_STORE_DATA[path]))
+        except Exception as e:
+            print(f"❌ Could not save {path}: {e}")
+            _mark_dirty(path)  # keep it pending — retried on the next flush and at shutdown
+
+async def _flusher():
+    while True:
+        await _flush_event.wait()
+        if not _closing:
+            await asyncio.sleep(FLUSH_INTERVAL)  # let a burst of mutations land in one write
+        _flush_event.clear()
+        await _flush_dirty()
+        if _closing:
+            return
+
+def _mark_dirty(path: str):
+    _dirty.add(path)
+    if _flush_event is not None:
+        _flush_event.set()
+
+def _persist_tokens():
+    _mark_dirty(TOKENS_FILE)
+
+def _persist_used_codes():
+    _mark_dirty(USED_CODES_FILE)
+
+def _persist_emails():
+    _mark_dirty(EMAILS_FILE)
+
+async def flush_stores():
+    """Writes any pending changes and stops the flusher (called on shutdown)."""
+    global _closing
+    _closing = True
+    if _flusher_task is not None and not _flusher_task.done():
+        _flush_event.set()
+        await _flusher_task
+    await _flush_dirty()
+
+# {guild_id: {role_id, ...}} of roles named "admin" — refreshed by the guild/role events below
+ADMIN_ROLES: dict[int, set[int]] = {}
 
-def _write_whitelist(data: list):
-    with open(WHITELIST_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+def cache_admin_roles(guild: discord.Guild):
+    ADMIN_ROLES[guild.id] = {role.id for role in guild.roles if role.name.lower() == "admin"}
 
 def is_mail_authorized(interaction: discord.Interaction) -> bool:
-    if interaction.user.guild_permissions.administrator:
-        return True
-    if any(role.name.lower() == "admin" for role in interaction.user.roles):
+    if is_admin(interaction):
         return True
     whitelist = _read_whitelist()
     return str(interaction.user.id) in whitelist
@@ -92,7 +213,10 @@ def is_mail_authorized(interaction: discord.Interaction) -> bool:
 def is_admin(interaction: discord.Interaction) -> bool:
     if interaction.user.guild_permissions.administrator:
         return True
-    return any(role.name.lower() == "admin" for role in interaction.user.roles)
+    if interaction.guild_id not in ADMIN_ROLES and interaction.guild:
+        cache_admin_roles(interaction.guild)
+    admin_ids = ADMIN_ROLES.get(interaction.guild_id, set())
+    return not admin_ids.isdisjoint(role.id for role in interaction.user.roles)
 
 def _parse_email_line(line: str) -> dict | None:
     normalized = line.replace(";", ":")
@@ -113,44 +237,107 @@ def _parse_email_line(line: str) -> dict | None:
 
 # ── Code Extraction & HTML Cleaning ───────────────────────────────────────────
 
-CODE_PATTERNS = [
-    r'(\d{6})',
-    r'code\s*[:\-\s]+(\d{4,8})',
-    r'verification\s*code\s*[:\-\s]+(\d{4,8})',
-    r'pin\s*[:\-\s]+(\d{4,8})',
-    r'otp\s*[:\-\s]+(\d{4,8})',
-]
+# One alternation scanned once. Priority matches the old pattern list: any 6-digit run wins
+# outright, then the first labelled code (code > pin > otp), then the first bare 4-8 digit number.
+CODE_RE = re.compile(
+    r'(?P<label>code|pin|otp)\s*[:\-\s]+(?P<kw>\d{4,8})'
+    r'|(?P<six>\d{6})'
+    r'|(?<!\d)(?P<any>\d{4,8})(?!\d)',
+    re.IGNORECASE,
+)
+CODE_LABELS = ("code", "pin", "otp")
 
 def extract_code(text: str) -> str | None:
-    text_lower = text.lower()
-    for pattern in CODE_PATTERNS:
-        match = re.search(pattern, text_lower)
-        if match:
-            return match.group(1)
-    match = re.search(r'(?<!\d)(\d{4,8})(?!\d)', text)
-    if match:
-        return match.group(1)
-    return None
+    labelled = {}
+    bare = None
+    for m in CODE_RE.finditer(text):
+        digits = m.group("kw") or m.group("six") or m.group("any")
+        if len(digits) >= 6:
+            return digits[:6]
+        if m.group("kw"):
+            labelled.setdefault(m.group("label").lower(), digits)
+        elif bare is None:
+            bare = digits
+    for label in CODE_LABELS:
+        if label in labelled:
+            return labelled[label]
+    return bare
+
+# Fallback HTML stripping (no selectolax). Each pattern is an unrolled loop with no nested
+# `.*?` that also stops at the next tag of its kind, so unclosed <style>/<script>/<tag
+# input is stripped in linear time instead of rescanning to the end for every start.
+STYLE_RE = re.compile(r'<style\b[^<>]*>[^<]*(?:<(?!/?style\b)[^<]*)*</style>', re.IGNORECASE)
+SCRIPT_RE = re.compile(r'<script\b[^<>]*>[^<]*(?:<(?!/?script\b)[^<]*)*</script>', re.IGNORECASE)
+TAG_RE = re.compile(r'<[^<>]+>')
+ZERO_WIDTH_RE = re.compile(r'[\u200b-\u200f\ufeff\u00ad\u2060\u180e\u202a-\u202e]')
 
 def strip_html(html_str: str) -> str:
     """Strips HTML tags, decodes HTML entities (&nbsp;), and removes invisible zero-width padding."""
     if not html_str:
         return ""
-    # 1. Unescape HTML entities (&nbsp;, &zwnj;, &#8478;, &amp;, etc.)
-    text = html.unescape(html_str)
-    # 2. Remove style, script, and all HTML tags
-    text = re.sub(r'<style[^>]*>.*?</style>|<script[^>]*>.*?</script>|<[^>]+>', ' ', text, flags=re.DOTALL | re.IGNORECASE)
+    if HTMLParser is not None:
+        # 1+2. Single linear tokenizer pass: drops style/script and decodes entities in text nodes
+        tree = HTMLParser(html_str)
+        tree.strip_tags(["style", "script"])
+        text = tree.root.text(separator=" ") if tree.root else ""
+    else:
+        # 1. Unescape HTML entities (&nbsp;, &zwnj;, &#8478;, &amp;, etc.)
+        text = html.unescape(html_str)
+        # 2. Remove style, script, and all HTML tags
+        text = STYLE_RE.sub(' ', text)
+        text = SCRIPT_RE.sub(' ', text)
+        text = TAG_RE.sub(' ', text)
     # 3. Remove invisible zero-width Unicode padding (\u200b-\u200f, \ufeff, \u00ad, \u2060, etc.)
-    text = re.sub(r'[\u200b-\u200f\ufeff\u00ad\u2060\u180e\u202a-\u202e]', '', text)
-    # 4. Replace non-breaking spaces and regular whitespace clutter with a single space
-    text = text.replace('\xa0', ' ')
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+    text = ZERO_WIDTH_RE.sub('', text)
+    # 4. Collapse whitespace clutter (str.split() also treats non-breaking spaces as whitespace)
+    return " ".join(text.split())
+
+# Users retry /code on the same account, which would re-strip the same bodies. Graph message
+# ids are stable, so remember each message's extracted code (or None) — never the body itself.
+MESSAGE_CODE_CACHE_SIZE = 2048
+MESSAGE_CODES: OrderedDict[str, str | None] = OrderedDict()
+
+def message_code(msg: dict) -> str | None:
+    """extract_code over a Graph message's subject + stripped body, memoized by message id."""
+    msg_id = msg.get("id")
+    if msg_id in MESSAGE_CODES:
+        MESSAGE_CODES.move_to_end(msg_id)
+        return MESSAGE_CODES[msg_id]
+
+    subject = msg.get("subject", "")
+    # A 6-digit run in the subject outranks anything the body could add, so skip
+    # stripping the body entirely in that (common) case
+    code = extract_code(subject)
+    if not code or len(code) < 6:
+        body = msg.get("body", {})
+        code = extract_code(subject + " " + strip_html(body.get("content", "")))
+
+    if msg_id:
+        MESSAGE_CODES[msg_id] = code
+        if len(MESSAGE_CODES) > MESSAGE_CODE_CACHE_SIZE:
+            MESSAGE_CODES.popitem(last=False)
+    return code
 
 
 # ── Token Acquisition & Validation ─────────────────────────────────────────────
 
-def get_token(refresh_token: str, client_id: str):
+# Access tokens live ~1h — reuse them per refresh_token instead of hitting /token every command.
+# Keyed by a digest so the long-lived refresh tokens aren't held a second time as dict keys.
+# {sha256(refresh_token): (access_token, expires_at)}
+ACCESS_TOKENS: dict[str, tuple[str, float]] = {}
+
+def _token_key(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+def drop_cached_token(refresh_token: str):
+    ACCESS_TOKENS.pop(_token_key(refresh_token), None)
+
+async def get_token(refresh_token: str, client_id: str):
+    key = _token_key(refresh_token)
+    cached = ACCESS_TOKENS.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0], None
+
     data = {
         "client_id": client_id,
         "refresh_token": refresh_token,
@@ -158,12 +345,17 @@ def get_token(refresh_token: str, client_id: str):
         "scope": "https://graph.microsoft.com/.default",
     }
     try:
-        resp = requests.post(TOKEN_URL, data=data, timeout=15)
-        result = resp.json()
+        async with aiohttp_session.post(TOKEN_URL, data=data) as resp:
+            result = _json_loads(await resp.read())
+    except asyncio.TimeoutError:
+        return None, "Network error: request timed out"
     except Exception as e:
         return None, f"Network error: {e}"
 
     if "access_token" in result:
+        # Treat the token as expired 60s early so it never lapses mid-request
+        expires_at = time.monotonic() + int(result.get("expires_in", 3600)) - 60
+        ACCESS_TOKENS[key] = (result["access_token"], expires_at)
         return result["access_token"], None
 
     err = result.get("error_description", str(result))
@@ -174,6 +366,8 @@ def get_token(refresh_token: str, client_id: str):
     else:
         return None, f"**Auth error:** {err[:300]}"
 
+UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+
 def parse_credentials(input_str: str, saved_tokens: dict):
     """
     Looks up the email in the saved tokens instantly. Also acts as a fallback parser 
@@ -193,16 +387,9 @@ def parse_credentials(input_str: str, saved_tokens: dict):
         if len(parts) == 2:
             return parts[0].strip(), parts[1].strip(), None
         
-        client_id = None
-        token_end = len(parts)
-        for j in range(len(parts) - 1, 0, -1):
-            if re.match(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', parts[j].strip(), re.IGNORECASE):
-                client_id = parts[j].strip()
-                token_end = j
-                break
-        if not client_id:
-            client_id = parts[-1].strip()
-            token_end = len(parts) - 1
+        # client_id is the right-most UUID-looking field; otherwise assume the last one
+        token_end = next((j for j in range(len(parts) - 1, 0, -1) if UUID_RE.match(parts[j].strip())), len(parts) - 1)
+        client_id = parts[token_end].strip()
         
         rt_start = 0
         if "@" in parts[0]:
@@ -217,91 +404,183 @@ def parse_credentials(input_str: str, saved_tokens: dict):
     return None, None, "❌ Wrong format.\nUse: `email@outlook.com` or paste an account combo string."
 
 
-# ── Fetch Uber Code (pure function — does NOT touch any files) ────────────────
+# ── Graph Requests ────────────────────────────────────────────────────────────
 
-def fetch_uber_code(refresh_token: str, client_id: str, used_codes: set = None, keyword: str = "uber"):
-    used_codes = used_codes or set()
-    kw = keyword.lower().strip()
+# Caps in-flight Graph calls across all users so bursts don't trip Microsoft's throttling
+graph_sem = asyncio.Semaphore(50)
+GRAPH_RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRY_AFTER = 10  # seconds; longer waits are reported instead of holding the interaction
 
-    token, error = get_token(refresh_token, client_id)
-    if error:
-        return {"success": False, "error": error}
+def _retry_delay(retry_after) -> float:
+    try:
+        return min(float(retry_after), MAX_RETRY_AFTER)
+    except (TypeError, ValueError):
+        return 1.0
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Prefer": "outlook.body-content-type=text"
+async def _post_batch(token: str, batch: dict):
+    """
+    POSTs a $batch payload under graph_sem. A throttled/unavailable reply — for the batch
+    itself or the messages sub-request — waits out Retry-After and is retried once.
+    Returns (status, raw_body, responses_by_id).
+    """
+    for attempt in range(2):
+        async with graph_sem:
+            async with aiohttp_session.post(
+                f"{GRAPH_URL}/$batch",
+                headers={"Authorization": f"Bearer {token}"},
+                json=batch,
+            ) as resp:
+                status = resp.status
+                retry_after = resp.headers.get("Retry-After")
+                raw = await resp.read()
+
+        # Batch responses are not guaranteed to come back in request order
+        responses = {}
+        retry = status in GRAPH_RETRY_STATUSES
+        if status == 200:
+            responses = {r.get("id"): r for r in _json_loads(raw).get("responses", [])}
+            msgs_part = responses.get("messages", {})
+            if msgs_part.get("status") in GRAPH_RETRY_STATUSES:
+                retry = True
+                retry_after = msgs_part.get("headers", {}).get("Retry-After")
+
+        if attempt == 0 and retry:
+            await asyncio.sleep(_retry_delay(retry_after))
+            continue
+        return status, raw, responses
+
+async def fetch_me_and_messages(refresh_token: str, client_id: str, params: dict, headers: dict = None):
+    """
+    Fetches the account address (/me) and a page of /me/messages in a single $batch
+    round-trip. Returns (account_email, messages, error).
+    """
+    query = urlencode(params, quote_via=quote, safe="$,'()/:")
+    batch = {
+        "requests": [
+            {"id": "me", "method": "GET", "url": "/me?$select=mail,userPrincipalName"},
+            {"id": "messages", "method": "GET", "url": f"/me/messages?{query}", "headers": headers or {}},
+        ]
     }
 
-    try:
-        me_resp = requests.get(f"{GRAPH_URL}/me?$select=mail,userPrincipalName", headers=headers, timeout=15)
-        me = me_resp.json()
-    except Exception as e:
-        return {"success": False, "error": f"Network error: {e}"}
+    for attempt in range(2):
+        token, error = await get_token(refresh_token, client_id)
+        if error:
+            return "Unknown", None, error
 
-    account_email = me.get("mail") or me.get("userPrincipalName") or "Unknown"
+        try:
+            status, raw, responses = await _post_batch(token, batch)
+        except asyncio.TimeoutError:
+            return "Unknown", None, "Network error: request timed out"
+        except Exception as e:
+            return "Unknown", None, f"Network error: {e}"
+
+        # A cached access token can be revoked before it expires — drop it and refresh once
+        msgs_status = responses.get("messages", {}).get("status")
+        if attempt == 0 and 401 in (status, msgs_status):
+            drop_cached_token(refresh_token)
+            continue
+        break
 
-    params = {
-        "$top": 200,
-        "$select": "subject,body,from,receivedDateTime",
-    }
+    if status != 200:
+        return "Unknown", None, f"Graph error {status}: {raw.decode('utf-8', 'replace')[:200]}"
 
-    try:
-        resp = requests.get(
-            f"{GRAPH_URL}/me/messages",
-            headers={**headers, "ConsistencyLevel": "eventual"},
-            params=params, timeout=15,
-        )
-    except Exception as e:
-        return {"success": False, "error": f"Network error: {e}", "email": account_email}
+    me_part = responses.get("me", {})
+    msgs_part = responses.get("messages", {})
 
-    if resp.status_code != 200:
-        return {"success": False, "error": f"Graph error {resp.status_code}: {resp.text[:200]}", "email": account_email}
+    me = me_part.get("body", {}) if me_part.get("status") == 200 else {}
+    account_email = me.get("mail") or me.get("userPrincipalName") or "Unknown"
 
-    messages = resp.json().get("value", [])
-    if not messages:
-        return {"success": False, "error": "No emails found in inbox", "email": account_email}
+    if msgs_part.get("status") != 200:
+        body = json.dumps(msgs_part.get("body", {}))
+        return account_email, None, f"Graph error {msgs_part.get('status')}: {body[:200]}"
 
-    def parse_date(d):
-        try:
-            return datetime.fromisoformat(d.replace("Z", "+00:00"))
-        except:
-            return datetime.min
+    return account_email, msgs_part.get("body", {}).get("value", []), None
 
-    messages.sort(key=lambda x: parse_date(x.get("receivedDateTime", "")), reverse=True)
 
-    for msg in messages:
-        subject = msg.get("subject", "").lower()
-        if f"your {kw} verification code" in subject or "verification code" in subject:
-            body = msg.get("body", {})
-            body_text = strip_html(body.get("content", ""))
-            code = extract_code(subject + " " + body_text)
-            if code and code not in used_codes:
-                return {
-                    "success": True,
-                    "code": code,
-                    "subject": msg.get("subject", "")[:100],
-                    "from": msg.get("from", {}).get("emailAddress", {}).get("address", ""),
-                    "date": msg.get("receivedDateTime", "")[:19].replace("T", " "),
-                    "email": account_email,
-                }
+# ── Fetch Uber Code (pure function — does NOT touch any files) ────────────────
 
+def _pick_code_message(messages: list, kw: str, used_codes: set):
+    """Returns (msg, subject, sender, code) for the best unused code in `messages`, or None."""
+    # Single pass, newest first. Rank 0: "verification code" subject (wins immediately),
+    # 1: keyword in the subject, 2: keyword in the sender. A message is only examined (and its
+    # body stripped) if it could beat the best match so far; ties go to the newer message.
+    best = None
+    best_rank = 3
     for msg in messages:
-        subject = msg.get("subject", "").lower()
-        from_addr = msg.get("from", {}).get("emailAddress", {}).get("address", "").lower()
-        if kw not in subject and kw not in from_addr:
+        msubj = msg.get("subject", "")
+        mfrom = msg.get("from", {}).get("emailAddress", {}).get("address", "")
+        subject = msubj.lower()
+        if "verification code" in subject:
+            rank = 0
+        elif kw in subject:
+            rank = 1
+        elif kw in mfrom.lower():
+            rank = 2
+        else:
+            continue
+        if rank >= best_rank:
+            continue
+
+        # used_codes is checked outside the memo: a cached code can be consumed later
+        code = message_code(msg)
+        if not code or code in used_codes:
             continue
-        body = msg.get("body", {})
-        body_text = strip_html(body.get("content", ""))
-        code = extract_code(subject + " " + body_text)
-        if code and code not in used_codes:
-            return {
-                "success": True,
-                "code": code,
-                "subject": msg.get("subject", "")[:100],
-                "from": msg.get("from", {}).get("emailAddress", {}).get("address", ""),
-                "date": msg.get("receivedDateTime", "")[:19].replace("T", " "),
-                "email": account_email,
-            }
+
+        best, best_rank = (msg, msubj, mfrom, code), rank
+        if rank == 0:
+            break
+    return best
+
+async def fetch_uber_code(refresh_token: str, client_id: str, used_codes: set = None, keyword: str = "uber"):
+    used_codes = used_codes or set()
+    kw = keyword.lower().strip()
+
+    # Filter server-side so only candidate bodies are transferred. receivedDateTime has to
+    # appear in $filter before it can be used in $orderby, otherwise Graph rejects the
+    # query as InefficientFilter.
+    kw_odata = kw.replace("'", "''")
+    params = {
+        "$top": 20,
+        "$orderby": "receivedDateTime desc",
+        "$filter": (
+            "receivedDateTime ge 1900-01-01T00:00:00Z and "
+            f"(contains(subject,'verification code') or contains(subject,'{kw_odata}'))"
+        ),
+        "$select": "id,subject,body,from,receivedDateTime",
+    }
+
+    headers = {
+        "Prefer": "outlook.body-content-type=text",
+        "ConsistencyLevel": "eventual",
+    }
+    account_email, messages, error = await fetch_me_and_messages(refresh_token, client_id, params, headers)
+    if error:
+        return {"success": False, "error": error, "email": account_email}
+
+    best = _pick_code_message(messages, kw, used_codes)
+    if best is None:
+        # The subject filter can't see sender-only matches (keyword only in the from address),
+        # and its rows may all be used or code-less — rescan the newest mail unfiltered, as
+        # deep as the query went before it was filtered. Overlapping messages hit MESSAGE_CODES.
+        wide_params = {k: v for k, v in params.items() if k != "$filter"}
+        wide_params["$top"] = 200
+        account_email, wide, error = await fetch_me_and_messages(refresh_token, client_id, wide_params, headers)
+        if error:
+            return {"success": False, "error": error, "email": account_email}
+        if not messages and not wide:
+            return {"success": False, "error": "No emails found in inbox", "email": account_email}
+        best = _pick_code_message(wide, kw, used_codes)
+
+    if best:
+        msg, msubj, mfrom, code = best
+        return {
+            "success": True,
+            "code": code,
+            "subject": msubj[:100],
+            "from": mfrom,
+            "date": msg.get("receivedDateTime", "")[:19].replace("T", " "),
+            "email": account_email,
+        }
 
     return {
         "success": False,
@@ -326,9 +605,7 @@ async def password_slash(interaction: discord.Interaction, email: str):
     if ":" in email_key:
         email_key = email_key.split(":")[0].strip()
 
-    async with file_lock:
-        tokens = _read_tokens()
-        emails_list = _read_emails()
+    tokens = TOKENS
 
     # 1. Check associated tokens database (from /upload)
     if email_key in tokens:
@@ -340,7 +617,7 @@ async def password_slash(interaction: discord.Interaction, email: str):
         return
 
     # 2. Check dispenser database (from /addmails)
-    for e in emails_list:
+    for e in EMAILS:
         if e["email"] == email_key:
             pwd = e.get("password")
             if pwd:
@@ -354,6 +631,12 @@ async def password_slash(interaction: discord.Interaction, email: str):
 
 # ── /code ──────────────────────────────────────────────────────────────────────
 
+# Static parts of the /code replies; each reply copies a template and only adds its fields
+CODE_FOUND_TEMPLATE = discord.Embed(title="✅ Code Found", color=0x00FF00)
+CODE_FOUND_TEMPLATE.set_footer(text="Only you can see this")
+CODE_FAILED_TEMPLATE = discord.Embed(title="❌ Failed", color=0xFF0000)
+CODE_FAILED_TEMPLATE.set_footer(text="Only you can see this")
+
 @bot.tree.command(name="code", description="Get code using an email address, or refresh_token:client_id")
 @app_commands.describe(
     email_or_token="Enter the email address (e.g., test@outlook.com) OR refresh_token:client_id",
@@ -362,64 +645,38 @@ async def password_slash(interaction: discord.Interaction, email: str):
 async def code_slash(interaction: discord.Interaction, email_or_token: str, keyword: str = "uber"):
     await interaction.response.defer(ephemeral=True)
 
-    async with file_lock:
-        saved = _read_tokens()
-        
-    rt, cid, err = parse_credentials(email_or_token, saved)
+    rt, cid, err = parse_credentials(email_or_token, TOKENS)
     if err:
         await interaction.followup.send(err, ephemeral=True)
         return
 
-    async with file_lock:
-        all_used = _read_used_codes()
     token_key = rt[:20] 
-    used_set = set(all_used.get(token_key, []))
+    used_set = set(USED_CODES.get(token_key, []))
 
-    result = fetch_uber_code(refresh_token=rt, client_id=cid, used_codes=used_set, keyword=keyword)
+    result = await fetch_uber_code(refresh_token=rt, client_id=cid, used_codes=used_set, keyword=keyword)
 
     if result["success"]:
         # Update Used Codes to prevent duplicates
         async with file_lock:
-            all_used = _read_used_codes()
-            if token_key not in all_used:
-                all_used[token_key] = []
-            all_used[token_key].append(result["code"])
-            _write_used_codes(all_used)
+            USED_CODES.setdefault(token_key, []).append(result["code"])
+            _persist_used_codes()
 
-        embed = discord.Embed(title="✅ Code Found", color=0x00FF00)
+        embed = CODE_FOUND_TEMPLATE.copy()
         embed.add_field(name="Code", value=f"**{result['code']}**", inline=False)
         embed.add_field(name="Email", value=f"`{result['email']}`", inline=True)
         embed.add_field(name="Subject", value=result.get("subject", "N/A"), inline=False)
         embed.add_field(name="Date", value=result.get("date", "N/A"), inline=True)
     else:
-        embed = discord.Embed(title="❌ Failed", description=result["error"], color=0xFF0000)
+        embed = CODE_FAILED_TEMPLATE.copy()
+        embed.description = result["error"]
         embed.add_field(name="Email", value=f"`{result.get('email', 'Unknown')}`", inline=True)
 
-    embed.set_footer(text="Only you can see this")
     await interaction.followup.send(embed=embed, ephemeral=True)
 
 
 # ── /read ──────────────────────────────────────────────────────────────────────
 
-def fetch_recent_emails(refresh_token: str, client_id: str, count: int = 3, order: str = "latest"):
-    token, error = get_token(refresh_token, client_id)
-    if error:
-        return None, error
-
-    # "Prefer: outlook.body-content-type=text" tells Microsoft Graph to convert HTML layouts to readable text
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Prefer": "outlook.body-content-type=text"
-    }
-
-    try:
-        me_resp = requests.get(f"{GRAPH_URL}/me?$select=mail,userPrincipalName", headers=headers, timeout=15)
-        me = me_resp.json()
-    except Exception as e:
-        return None, f"Network error: {e}"
-
-    account_email = me.get("mail") or me.get("userPrincipalName") or "Unknown"
-
+async def fetch_recent_emails(refresh_token: str, client_id: str, count: int = 3, order: str = "latest"):
     orderby_direction = "desc" if order == "latest" else "asc"
 
     params = {
@@ -428,15 +685,13 @@ def fetch_recent_emails(refresh_token: str, client_id: str, count: int = 3, orde
         "$select": "subject,body,from,receivedDateTime",
     }
 
-    try:
-        resp = requests.get(f"{GRAPH_URL}/me/messages", headers=headers, params=params, timeout=15)
-    except Exception as e:
-        return None, f"Network error: {e}"
-
-    if resp.status_code != 200:
-        return None, f"Graph error {resp.status_code}: {resp.text[:200]}"
+    # "Prefer: outlook.body-content-type=text" tells Microsoft Graph to convert HTML layouts to readable text
+    account_email, messages, error = await fetch_me_and_messages(refresh_token, client_id, params, headers={
+        "Prefer": "outlook.body-content-type=text",
+    })
+    if error:
+        return None, error
 
-    messages = resp.json().get("value", [])
     results = []
     for msg in messages:
         body = msg.get("body", {})
@@ -464,15 +719,12 @@ async def read_slash(interaction: discord.Interaction, email_or_token: str, amou
     if amount < 1: amount = 1
     if amount > 10: amount = 10
 
-    async with file_lock:
-        saved = _read_tokens()
-
-    rt, cid, err = parse_credentials(email_or_token, saved)
+    rt, cid, err = parse_credentials(email_or_token, TOKENS)
     if err:
         await interaction.followup.send(err, ephemeral=True)
         return
 
-    emails, error = fetch_recent_emails(rt, cid, count=amount, order=order)
+    emails, error = await fetch_recent_emails(rt, cid, count=amount, order=order)
 
     if error:
         embed = discord.Embed(title="❌ Failed", description=error, color=0xFF0000)
@@ -509,49 +761,39 @@ async def read_slash(interaction: discord.Interaction, email_or_token: str, amou
 
 # ── /upload ────────────────────────────────────────────────────────────────────
 
-@bot.tree.command(name="upload", description="Upload a .txt file with tokens (one per line)")
-@app_commands.describe(file="TXT file: email:pass:refresh_token:client_id per line")
-async def upload_slash(interaction: discord.Interaction, file: discord.Attachment):
-    await interaction.response.defer(ephemeral=True)
-
-    if not file.filename.endswith(".txt"):
-        await interaction.followup.send("❌ Please upload a `.txt` file.", ephemeral=True)
-        return
-
-    try:
-        content = (await file.read()).decode("utf-8")
-    except Exception as e:
-        await interaction.followup.send(f"❌ Could not read file: {e}", ephemeral=True)
-        return
-
-    lines = [l.strip() for l in content.splitlines() if l.strip() and not l.strip().startswith("#")]
-    if not lines:
-        await interaction.followup.send("❌ File is empty or has no valid lines.", ephemeral=True)
-        return
-
+def _parse_upload(raw: bytes):
+    """
+    Parses an /upload file (email:pass:refresh_token:client_id per line), decoding it line by
+    line instead of materializing the whole file as str + line lists.
+    Returns (parsed, errors, seen); raises UnicodeDecodeError on non-UTF-8 input.
+    """
+    buf = io.TextIOWrapper(io.BytesIO(raw), encoding="utf-8", newline="")
     parsed = {}
     errors = []
-    for i, line in enumerate(lines, 1):
-        parts = line.split(":")
-        if len(parts) < 4:
+    seen = 0
+    for i, line in enumerate(buf, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        seen += 1
+        parts = line.split(":", 2)
+        if len(parts) < 3 or ":" not in parts[2]:
             errors.append(f"Line {i}: not enough fields")
             continue
 
         email = parts[0].strip()
         password = parts[1].strip()
 
-        client_id = None
-        token_end = len(parts)
-        for j in range(len(parts) - 1, 1, -1):
-            if re.match(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', parts[j].strip(), re.IGNORECASE):
-                client_id = parts[j].strip()
-                token_end = j
-                break
-        if not client_id:
-            client_id = parts[-1].strip()
-            token_end = len(parts) - 1
-
-        refresh_token = ":".join(parts[2:token_end]).strip()
+        # Fast path: client_id is the last field. Otherwise scan right-to-left for the UUID
+        # (extra trailing fields), defaulting to the last field as before.
+        refresh_token, client_id = parts[2].rsplit(":", 1)
+        if not UUID_RE.match(client_id.strip()):
+            fields = parts[2].split(":")
+            token_end = next((j for j in range(len(fields) - 1, -1, -1) if UUID_RE.match(fields[j].strip())), len(fields) - 1)
+            refresh_token = ":".join(fields[:token_end])
+            client_id = fields[token_end]
+        refresh_token = refresh_token.strip()
+        client_id = client_id.strip()
 
         if not email or "@" not in email:
             errors.append(f"Line {i}: invalid email")
@@ -567,9 +809,36 @@ async def upload_slash(interaction: discord.Interaction, file: discord.Attachmen
             "password": password,
             "dispensed": False  # New flag for non-destructive export
         }
+    return parsed, errors, seen
+
+@bot.tree.command(name="upload", description="Upload a .txt file with tokens (one per line)")
+@app_commands.describe(file="TXT file: email:pass:refresh_token:client_id per line")
+async def upload_slash(interaction: discord.Interaction, file: discord.Attachment):
+    await interaction.response.defer(ephemeral=True)
+
+    if not file.filename.endswith(".txt"):
+        await interaction.followup.send("❌ Please upload a `.txt` file.", ephemeral=True)
+        return
+
+    try:
+        raw = await file.read()
+    except Exception as e:
+        await interaction.followup.send(f"❌ Could not read file: {e}", ephemeral=True)
+        return
+
+    # Large imports take a while to parse — keep that CPU work off the event loop
+    try:
+        parsed, errors, seen = await asyncio.to_thread(_parse_upload, raw)
+    except UnicodeDecodeError as e:
+        await interaction.followup.send(f"❌ Could not read file: {e}", ephemeral=True)
+        return
+
+    if not seen:
+        await interaction.followup.send("❌ File is empty or has no valid lines.", ephemeral=True)
+        return
 
     async with file_lock:
-        tokens = _read_tokens()
+        tokens = TOKENS
         added = 0
         skipped = []
         for email, data in parsed.items():
@@ -578,7 +847,7 @@ async def upload_slash(interaction: discord.Interaction, file: discord.Attachmen
             else:
                 tokens[email] = data
                 added += 1
-        _write_tokens(tokens)
+        _persist_tokens()
         total_saved = len(tokens)
 
     desc = f"✅ **{added}** imported\n📁 **{total_saved}** total"
@@ -618,7 +887,7 @@ async def export_slash(interaction: discord.Interaction, amount: int):
         return
 
     async with file_lock:
-        tokens = _read_tokens()
+        tokens = TOKENS
 
         # Filter for accounts that have NOT been dispensed yet
         available = [k for k, v in tokens.items() if not v.get("dispensed", False)]
@@ -628,20 +897,23 @@ async def export_slash(interaction: discord.Interaction, amount: int):
             return
 
         keys_to_take = available[:amount]
-        lines = []
-        for k in keys_to_take:
+        # Encode each line straight into the upload buffer — no joined copy of the whole export
+        buf = io.BytesIO()
+        for i, k in enumerate(keys_to_take):
             tokens[k]["dispensed"] = True  # Mark as taken but KEEP associated
             d = tokens[k]
             pwd = d.get('password')
             if not pwd:
                 pwd = ""
-            lines.append(f"{k}:{pwd}:{d['refresh_token']}:{d['client_id']}")
+            if i:
+                buf.write(b"\n")
+            buf.write(f"{k}:{pwd}:{d['refresh_token']}:{d['client_id']}".encode("utf-8"))
 
-        _write_tokens(tokens)
+        _persist_tokens()
         remaining = sum(1 for v in tokens.values() if not v.get("dispensed", False))
 
-    content = "\n".join(lines)
-    txt_file = discord.File(io.BytesIO(content.encode("utf-8")), filename="tokens_export.txt")
+    buf.seek(0)
+    txt_file = discord.File(buf, filename="tokens_export.txt")
 
     desc = f"📤 Dispensed **{len(keys_to_take)}**\n📁 **{remaining}** available to take remaining"
     await interaction.followup.send(desc, file=txt_file, ephemeral=True)
@@ -664,18 +936,17 @@ async def export_slash(interaction: discord.Interaction, amount: int):
 async def list_slash(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
 
-    async with file_lock:
-        tokens = _read_tokens()
+    tokens = TOKENS
 
     if not tokens:
         await interaction.followup.send("❌ No saved tokens.", ephemeral=True)
         return
 
-    emails = list(tokens.keys())
-    desc = f"📁 **{len(emails)}** saved account(s):\n\n"
-    desc += "\n".join(f"`{e}`" for e in emails[:20])
-    if len(emails) > 20:
-        desc += f"\n\n...and {len(emails) - 20} more"
+    total = len(tokens)
+    desc = f"📁 **{total}** saved account(s):\n\n"
+    desc += "\n".join(f"`{e}`" for e in islice(tokens, 20))
+    if total > 20:
+        desc += f"\n\n...and {total - 20} more"
 
     embed = discord.Embed(title="📋 Saved Accounts", description=desc, color=0x5865F2)
     embed.set_footer(text="Only you can see this")
@@ -694,13 +965,13 @@ async def remove_slash(interaction: discord.Interaction, email: str):
         return
 
     async with file_lock:
-        tokens = _read_tokens()
+        tokens = TOKENS
         email = email.strip().lower()
         if email not in tokens:
             await interaction.followup.send(f"❌ `{email}` not found.", ephemeral=True)
             return
         del tokens[email]
-        _write_tokens(tokens)
+        _persist_tokens()
         remaining = len(tokens)
 
     await interaction.followup.send(f"✅ Removed `{email}`. **{remaining}** remaining.", ephemeral=True)
@@ -711,8 +982,7 @@ async def remove_slash(interaction: discord.Interaction, email: str):
 @bot.tree.command(name="stock", description="Check how many accounts are saved")
 async def stock_slash(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
-    async with file_lock:
-        tokens = _read_tokens()
+    tokens = TOKENS
     avail = sum(1 for v in tokens.values() if not v.get("dispensed", False))
     total = len(tokens)
     embed = discord.Embed(title="📊 Stock Status", description=f"**{avail}** available to take\n**{total}** total associated", color=0x5865F2)
@@ -749,19 +1019,18 @@ async def addmails_slash(interaction: discord.Interaction, combos: str):
             errors.append(f"Line {i}: could not parse `{line[:60]}`")
 
     async with file_lock:
-        existing = _read_emails()
-        existing_emails = {e["email"] for e in existing}
         added = 0
         skipped = []
         for entry in parsed:
-            if entry["email"] in existing_emails:
+            if entry["email"] in EMAIL_KEYS:
                 skipped.append(f"`{entry['email']}` (duplicate)")
             else:
-                existing.append(entry)
-                existing_emails.add(entry["email"])
+                EMAILS.append(entry)
+                EMAIL_KEYS.add(entry["email"])
                 added += 1
-        _write_emails(existing)
-        total = len(existing)
+        if added:
+            _persist_emails()
+        total = len(EMAILS)
 
     desc = f"✅ **{added}** added\n📁 **{total}** total"
     if skipped:
@@ -803,25 +1072,26 @@ async def exportmail_slash(interaction: discord.Interaction, amount: int):
         return
 
     async with file_lock:
-        emails = _read_emails()
-        if not emails:
+        if not EMAILS:
             await interaction.followup.send("❌ No saved email accounts.", ephemeral=True)
             return
 
-        taken = emails[:amount]
-        remaining_list = emails[amount:]
-        _write_emails(remaining_list)
-        remaining = len(remaining_list)
+        taken = EMAILS[:amount]
+        del EMAILS[:amount]
+        EMAIL_KEYS.difference_update(e["email"] for e in taken)
+        _persist_emails()
+        remaining = len(EMAILS)
 
-    lines = []
-    for entry in taken:
+    buf = io.BytesIO()
+    for i, entry in enumerate(taken):
+        if i:
+            buf.write(b"\n")
         if entry.get("recovery"):
-            lines.append(f"{entry['email']}:{entry['password']}:{entry['recovery']}")
+            buf.write(f"{entry['email']}:{entry['password']}:{entry['recovery']}".encode("utf-8"))
         else:
-            lines.append(f"{entry['email']}:{entry['password']}")
-
-    content = "\n".join(lines)
-    txt_file = discord.File(io.BytesIO(content.encode("utf-8")), filename="emails_export.txt")
+            buf.write(f"{entry['email']}:{entry['password']}".encode("utf-8"))
+    buf.seek(0)
+    txt_file = discord.File(buf, filename="emails_export.txt")
 
     desc = f"📤 Dispensed **{len(taken)}**\n📁 **{remaining}** remaining"
     await interaction.followup.send(desc, file=txt_file, ephemeral=True)
@@ -846,9 +1116,7 @@ async def stockmail_slash(interaction: discord.Interaction):
     if not is_mail_authorized(interaction):
         await interaction.followup.send("❌ You are not whitelisted to use this command.", ephemeral=True)
         return
-    async with file_lock:
-        emails = _read_emails()
-    embed = discord.Embed(title="📊 Mail Stock", description=f"**{len(emails)}** email accounts available", color=0x5865F2)
+    embed = discord.Embed(title="📊 Mail Stock", description=f"**{len(EMAILS)}** email accounts available", color=0x5865F2)
     await interaction.followup.send(embed=embed, ephemeral=True)
 
 
@@ -901,7 +1169,7 @@ async def mailwhitelist_slash(interaction: discord.Interaction, action: str, use
                 await interaction.followup.send(f"⚠️ {user.mention} is already whitelisted.", ephemeral=True)
                 return
             whitelist.append(uid)
-            _write_whitelist(whitelist)
+            await _write_whitelist(whitelist)
             await interaction.followup.send(f"✅ Added {user.mention} to the mail whitelist.", ephemeral=True)
 
         elif action == "remove":
@@ -909,7 +1177,7 @@ async def mailwhitelist_slash(interaction: discord.Interaction, action: str, use
                 await interaction.followup.send(f"❌ {user.mention} is not in the whitelist.", ephemeral=True)
                 return
             whitelist.remove(uid)
-            _write_whitelist(whitelist)
+            await _write_whitelist(whitelist)
             await interaction.followup.send(f"✅ Removed {user.mention} from the mail whitelist.", ephemeral=True)
 
         else:
@@ -920,12 +1188,12 @@ async def mailwhitelist_slash(interaction: discord.Interaction, action: str, use
 
 @bot.event
 async def on_ready():
+    for guild in bot.guilds:
+        cache_admin_roles(guild)
     print(f"✅ Bot online: {bot.user}")
     print(f"📁 Data dir: {DATA_DIR}")
     print(f"📁 Tokens: {TOKENS_FILE}")
-    if os.path.exists(TOKENS_FILE):
-        with open(TOKENS_FILE, "r") as f:
-            print(f"📁 Accounts: {len(json.load(f))}")
+    print(f"📁 Accounts: {len(TOKENS)}")
     try:
         synced = await bot.tree.sync()
         print(f"✅ Synced {len(synced)} commands")
@@ -933,10 +1201,48 @@ async def on_ready():
         print(f"❌ Sync failed: {e}")
 
 
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    cache_admin_roles(guild)
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    cache_admin_roles(role.guild)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    cache_admin_roles(role.guild)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    cache_admin_roles(after.guild)
+
+
 # ── Run ────────────────────────────────────────────────────────────────────────
+
+async def main(token: str):
+    # bot.start() (unlike bot.run()) doesn't configure logging on its own
+    discord.utils.setup_logging()
+    # Render stops the worker with SIGTERM, whose default action skips the finally below and
+    # loses any store changes still waiting on the flusher. Close the bot instead so it runs.
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    except NotImplementedError:  # Windows event loops have no signal handlers
+        pass
+    try:
+        async with bot:
+            await bot.start(token)
+    finally:
+        await flush_stores()
+        if aiohttp_session and not aiohttp_session.closed:
+            await aiohttp_session.close()
+
 if __name__ == "__main__":
     token = os.getenv("DISCORD_BOT_TOKEN")
     if not token:
         print("❌ DISCORD_BOT_TOKEN missing in .env")
         exit(1)
-    bot.run(token)
+    try:
+        asyncio.run(main(token))
+    except KeyboardInterrupt:
+        pass